@@ -2,10 +2,706 @@
 # Northcliff Home Manager Display - Version 3.21 Gen
 # Requires Home Manager >= Version 9.38
 import time
+import os
+import asyncio
+import threading
+import re
+import mmap
+import stat
+import fcntl
+import glob
+import http.server
+import struct
+import zlib
+import bisect
+import collections
+import math
+import heapq
 import paho.mqtt.client as mqtt
 import json
+try: # Use the faster orjson parser if it's installed
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 from datetime import datetime
-from sense_hat import SenseHat
+try: # Only needed for the barometer and the sense_hat display backend
+    from sense_hat import SenseHat
+except ImportError:
+    SenseHat = None
+
+
+def convert_hsv_to_rgb(hue_value, saturation_value, brightness): # Hue in degrees, saturation and brightness in percent
+    hue_value = hue_value % 360 # Wrap hues of 360 or more and negative hues back onto the colour wheel
+    c_value = (brightness/100) * (saturation_value/100)
+    x_value = c_value * (1-abs((hue_value/60) % 2 - 1))
+    m_value = brightness/100 - c_value
+    if hue_value < 60:
+        red_value = c_value
+        green_value = x_value
+        blue_value = 0
+    elif hue_value < 120:
+        red_value = x_value
+        green_value = c_value
+        blue_value = 0
+    elif hue_value < 180:
+        red_value = 0
+        green_value = c_value
+        blue_value = x_value
+    elif hue_value < 240:
+        red_value = 0
+        green_value = x_value
+        blue_value = c_value
+    elif hue_value < 300:
+        red_value = x_value
+        green_value = 0
+        blue_value = c_value
+    else:
+        red_value = c_value
+        green_value = 0
+        blue_value = x_value
+    red = int((red_value + m_value) * 255)
+    green = int((green_value + m_value) * 255)
+    blue = int((blue_value + m_value) * 255)
+    return red,green,blue
+
+
+class HSVLookupTable(object): # Precomputed HSV to RGB conversions for integer hues and saturation/brightness levels on a fixed step
+    cache_file_header = b'NHMLUT2' # Followed by the step, the table and a CRC32 of the table
+    cache_file_crc = struct.Struct('<I')
+
+    def __init__(self, step=10, cache_file=None):
+        self.step = step
+        self.levels = 100//step + 1
+        self.table_size = 360 * self.levels * self.levels * 3
+        self.table = None
+        if cache_file is not None:
+            self.table = self.load_table(cache_file)
+        if self.table is None:
+            self.table = self.build_table()
+            if cache_file is not None:
+                self.save_table(cache_file)
+
+    def build_table(self):
+        table = bytearray(self.table_size)
+        offset = 0
+        for hue in range(360):
+            for saturation_level in range(self.levels):
+                for brightness_level in range(self.levels):
+                    table[offset:offset+3] = bytes(convert_hsv_to_rgb(hue, saturation_level*self.step, brightness_level*self.step))
+                    offset += 3
+        return table
+
+    def load_table(self, cache_file): # Returns None if there's no usable cached table
+        header = self.cache_file_header + bytes([self.step])
+        try:
+            with open(cache_file, 'rb') as f:
+                contents = f.read()
+        except OSError:
+            return None
+        if contents[:len(header)] != header or len(contents) != len(header) + self.table_size + self.cache_file_crc.size:
+            return None
+        table = contents[len(header):len(header)+self.table_size]
+        if self.cache_file_crc.unpack_from(contents, len(header)+self.table_size)[0] != zlib.crc32(table): # Corrupted, so rebuild it
+            return None
+        return bytearray(table)
+
+    def save_table(self, cache_file): # Written to a temporary file first so that an interrupted save never leaves a truncated cache
+        temporary_file = cache_file + '.tmp'
+        try:
+            with open(temporary_file, 'wb') as f:
+                f.write(self.cache_file_header + bytes([self.step]))
+                f.write(self.table)
+                f.write(self.cache_file_crc.pack(zlib.crc32(self.table)))
+            os.replace(temporary_file, cache_file)
+        except OSError as error:
+            print('Unable to cache HSV lookup table', error)
+
+    def lookup(self, hue_value, saturation_value, brightness):
+        saturation_level, saturation_remainder = divmod(saturation_value, self.step)
+        brightness_level, brightness_remainder = divmod(brightness, self.step)
+        if (hue_value % 1 or saturation_remainder or brightness_remainder or not 0 <= saturation_level < self.levels
+            or not 0 <= brightness_level < self.levels): # Not on the table's grid, so calculate it directly
+            return convert_hsv_to_rgb(hue_value, saturation_value, brightness)
+        offset = ((int(hue_value) % 360 * self.levels + int(saturation_level)) * self.levels + int(brightness_level)) * 3
+        table = self.table
+        return table[offset], table[offset+1], table[offset+2]
+
+    def lookup_batch(self, h_s_v_list): # The same as lookup for each triple, without a method call per triple
+        table = self.table
+        step = self.step
+        levels = self.levels
+        rgb_list = []
+        for hue_value, saturation_value, brightness in h_s_v_list:
+            saturation_level, saturation_remainder = divmod(saturation_value, step)
+            brightness_level, brightness_remainder = divmod(brightness, step)
+            if (hue_value % 1 or saturation_remainder or brightness_remainder or not 0 <= saturation_level < levels
+                or not 0 <= brightness_level < levels):
+                rgb_list.append(convert_hsv_to_rgb(hue_value, saturation_value, brightness))
+                continue
+            offset = ((int(hue_value) % 360 * levels + int(saturation_level)) * levels + int(brightness_level)) * 3
+            rgb_list.append((table[offset], table[offset+1], table[offset+2]))
+        return rgb_list
+
+
+def find_sense_hat_framebuffer(): # Returns the Sense HAT's framebuffer device path, or None if it can't be found
+    for name_file in sorted(glob.glob('/sys/class/graphics/fb*/name')):
+        with open(name_file) as f:
+            if f.read().strip() == 'RPi-Sense FB':
+                return '/dev/' + os.path.basename(os.path.dirname(name_file))
+    return None
+
+
+def framebuffer_rotation_offsets(rotation): # Maps each display buffer index to its byte offset in the framebuffer, matching SenseHat.set_rotation
+    offsets = []
+    for index in range(64):
+        x = index % 8
+        y = index // 8
+        if rotation == 0:
+            pixel = index
+        elif rotation == 90:
+            pixel = x*8 + 7 - y
+        elif rotation == 180:
+            pixel = 63 - index
+        elif rotation == 270:
+            pixel = (7-x)*8 + y
+        else:
+            raise ValueError('Rotation must be 0, 90, 180 or 270 degrees')
+        offsets.append(pixel * 2)
+    return offsets
+
+
+class SenseHatDisplay(object): # Display backend that drives the LED matrix through the sense_hat library
+    def __init__(self, sense_hat, rotation, full_frame_threshold):
+        self.sense = sense_hat
+        self.full_frame_threshold = full_frame_threshold # Push the whole frame rather than individual pixels when more pixels than this have changed
+        self.sense.set_rotation(rotation)
+        self.sense.clear()
+
+    def set_low_light(self, low_light):
+        self.sense.low_light = low_light
+
+    def write_pixels(self, display_buffer, dirty_pixels): # display_buffer holds red, green and blue bytes for each pixel
+        if len(dirty_pixels) > self.full_frame_threshold:
+            self.sense.set_pixels([display_buffer[offset:offset+3] for offset in range(0, 192, 3)])
+        else:
+            for index in dirty_pixels:
+                self.sense.set_pixel(index%8, index//8, display_buffer[index*3:index*3+3])
+
+    def clear(self):
+        self.sense.clear()
+
+    def close(self):
+        pass
+
+
+class FramebufferDisplay(object): # Display backend that writes RGB565 pixels straight into the memory mapped Sense HAT framebuffer
+    frame_size = 128 # 8x8 pixels of 2 bytes each
+    gamma_reset_ioctl = 61698 # The Sense HAT framebuffer driver's gamma reset request, as used by SenseHat.low_light
+    gamma_default = 0
+    gamma_low = 1
+
+    def __init__(self, device_path, rotation):
+        self.device_path = device_path
+        open_flags = os.O_RDWR
+        if not os.path.abspath(device_path).startswith('/dev/'): # A stand-in file, created if there isn't one yet. A missing device must fail rather than be created
+            open_flags |= os.O_CREAT
+        self.fb_file = os.fdopen(os.open(device_path, open_flags), 'r+b')
+        self.gamma_control = stat.S_ISCHR(os.fstat(self.fb_file.fileno()).st_mode)
+        if not self.gamma_control: # A regular file is standing in for the device, so make sure it's big enough to map
+            if os.fstat(self.fb_file.fileno()).st_size < self.frame_size:
+                self.fb_file.truncate(self.frame_size)
+        self.fb_map = mmap.mmap(self.fb_file.fileno(), self.frame_size)
+        self.frame = bytearray(self.fb_map[:self.frame_size]) # What's currently in the framebuffer, so that only changed bytes are written
+        self.offsets = framebuffer_rotation_offsets(rotation)
+
+    def set_low_light(self, low_light):
+        if self.gamma_control:
+            fcntl.ioctl(self.fb_file, self.gamma_reset_ioctl, self.gamma_low if low_light else self.gamma_default)
+
+    def write_pixels(self, display_buffer, dirty_pixels):
+        frame = self.frame
+        fb_map = self.fb_map
+        for index in dirty_pixels:
+            red = display_buffer[index*3]
+            green = display_buffer[index*3+1]
+            blue = display_buffer[index*3+2]
+            rgb565 = ((red & 0xF8) << 8) | ((green & 0xFC) << 3) | (blue >> 3)
+            low_byte = rgb565 & 0xFF
+            high_byte = rgb565 >> 8
+            offset = self.offsets[index]
+            if frame[offset] != low_byte or frame[offset+1] != high_byte:
+                frame[offset] = low_byte
+                frame[offset+1] = high_byte
+                fb_map[offset:offset+2] = frame[offset:offset+2]
+
+    def clear(self):
+        self.frame[:] = bytes(self.frame_size)
+        self.fb_map[:] = self.frame
+
+    def close(self):
+        self.fb_map.close()
+        self.fb_file.close()
+
+
+class BarometerSampler(object): # Reads the barometer on its own thread, oversampling and median filtering, so that readers never wait on I2C
+    def __init__(self, read_pressure, samples, sample_spacing, interval, valid_minimum=500, startup_delay=0.1, max_startup_delay=5):
+        self.read_pressure = read_pressure
+        self.samples = samples # Readings per sample
+        self.sample_spacing = sample_spacing # Seconds between readings within a sample
+        self.interval = interval # Seconds between samples
+        self.valid_minimum = valid_minimum # Readings at or below this are invalid. The sensor reads 0 while it's starting up
+        self.startup_delay = startup_delay
+        self.max_startup_delay = max_startup_delay
+        self.lock = threading.Lock()
+        self.pressure = None
+        self.sample_time = 0
+        self.first_sample = threading.Event()
+        self.sample_listeners = [] # Called with the time and pressure of each sample, on the sampler's thread
+
+    def sample(self): # Blocking. Returns the median of the valid readings, or None if there weren't any
+        readings = []
+        for reading_number in range(self.samples):
+            if reading_number > 0:
+                time.sleep(self.sample_spacing)
+            try:
+                reading = self.read_pressure()
+            except Exception as error: # Keep the sampler running whatever goes wrong with a read
+                print('Barometer Read Failed', error)
+                continue
+            if reading > self.valid_minimum:
+                readings.append(reading)
+        if not readings:
+            return None
+        readings.sort()
+        middle = len(readings) // 2
+        pressure = readings[middle] if len(readings) % 2 else (readings[middle-1] + readings[middle]) / 2
+        with self.lock:
+            self.pressure = round(pressure, 2)
+            self.sample_time = time.time()
+        for sample_listener in self.sample_listeners:
+            try:
+                sample_listener(self.sample_time, self.pressure)
+            except Exception as error:
+                print('Barometer Sample Listener Failed', error)
+        self.first_sample.set()
+        return pressure
+
+    def latest(self): # Returns the latest filtered pressure and its time, without blocking. Pressure is None until the first valid sample
+        with self.lock:
+            return self.pressure, self.sample_time
+
+    def run(self):
+        startup_delay = self.startup_delay
+        while self.sample() is None: # Back off while the sensor starts up, rather than spinning on it
+            time.sleep(startup_delay)
+            startup_delay = min(startup_delay * 2, self.max_startup_delay)
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+
+    def start(self):
+        threading.Thread(target=self.run, name='barometer_sampler', daemon=True).start()
+
+
+class BarometerStore(object): # Memory mapped ring buffers of barometer readings at several resolutions, kept across restarts
+    file_header = struct.Struct('<8sH') # Magic and number of tiers, followed by each tier's resolution and capacity
+    tier_header = struct.Struct('<II')
+    record = struct.Struct('<dfI') # Bucket start time, mean pressure and a CRC32 of the two, so that torn or stale records are ignored
+    magic = b'NHMBARO1'
+
+    def __init__(self, store_file, tiers): # Tiers are (resolution in seconds, capacity) pairs, finest first. No file keeps the store in memory
+        self.tiers = tiers
+        self.lock = threading.Lock()
+        header = self.file_header.pack(self.magic, len(tiers)) + b''.join(self.tier_header.pack(resolution, capacity) for resolution, capacity in tiers)
+        self.tier_offsets = []
+        offset = len(header)
+        for resolution, capacity in tiers:
+            self.tier_offsets.append(offset)
+            offset += capacity * self.record.size
+        self.store_size = offset
+        self.accumulators = [[None, 0.0, 0] for tier in tiers] # Bucket number, pressure total and reading count for each tier's current bucket
+        self.store_file = None
+        if store_file is None:
+            self.store_map = mmap.mmap(-1, self.store_size)
+        else:
+            self.store_file = open(store_file, 'a+b') # Creates the file if it's not there, without truncating it
+            self.store_file.seek(0)
+            if self.store_file.read(len(header)) != header or os.fstat(self.store_file.fileno()).st_size != self.store_size:
+                print('Creating new barometer store', store_file)
+                self.store_file.truncate(0)
+                self.store_file.truncate(self.store_size)
+            self.store_map = mmap.mmap(self.store_file.fileno(), self.store_size)
+        self.store_map[:len(header)] = header
+
+    def add_reading(self, reading_time, pressure): # O(1). Each tier's bucket is written once the following bucket starts
+        with self.lock:
+            if self.store_map.closed:
+                return
+            for tier, (resolution, capacity) in enumerate(self.tiers):
+                accumulator = self.accumulators[tier]
+                bucket = int(reading_time // resolution)
+                if accumulator[0] != bucket:
+                    if accumulator[0] is not None:
+                        self.write_record(tier, accumulator[0], accumulator[1] / accumulator[2])
+                    accumulator[:] = [bucket, 0.0, 0]
+                accumulator[1] += pressure
+                accumulator[2] += 1
+
+    def write_record(self, tier, bucket, pressure):
+        resolution, capacity = self.tiers[tier]
+        bucket_time = float(bucket * resolution)
+        packed_pressure = struct.pack('<df', bucket_time, pressure)
+        offset = self.tier_offsets[tier] + (bucket % capacity) * self.record.size
+        self.store_map[offset:offset+self.record.size] = packed_pressure + struct.pack('<I', zlib.crc32(packed_pressure))
+
+    def read_record(self, tier, bucket): # Returns the bucket's mean pressure, or None if the slot holds something else
+        resolution, capacity = self.tiers[tier]
+        offset = self.tier_offsets[tier] + (bucket % capacity) * self.record.size
+        bucket_time, pressure, crc = self.record.unpack_from(self.store_map, offset)
+        if bucket_time != bucket * resolution or crc != zlib.crc32(self.store_map[offset:offset+12]):
+            return None
+        return pressure
+
+    def pressure_at(self, timestamp, tolerance): # Returns the stored pressure nearest to timestamp within tolerance seconds, using the finest tier that has one
+        with self.lock:
+            for tier, (resolution, capacity) in enumerate(self.tiers):
+                bucket = int(timestamp // resolution)
+                for step in range(int(tolerance // resolution) + 1):
+                    for candidate in ((bucket,) if step == 0 else (bucket - step, bucket + step)):
+                        pressure = self.read_record(tier, candidate)
+                        if pressure is not None:
+                            return round(pressure, 2)
+        return None
+
+    def readings(self, since, resolution): # Returns (bucket start time, pressure) for the tier with this resolution, oldest first
+        tier = [tier_resolution for tier_resolution, capacity in self.tiers].index(resolution)
+        capacity = self.tiers[tier][1]
+        last_bucket = int(time.time() // resolution)
+        first_bucket = max(int(since // resolution), last_bucket - capacity + 1)
+        with self.lock:
+            return [(float(bucket * resolution), round(pressure, 2)) for bucket in range(first_bucket, last_bucket + 1)
+                    for pressure in (self.read_record(tier, bucket),) if pressure is not None]
+
+    def close(self):
+        with self.lock:
+            self.store_map.flush()
+            self.store_map.close()
+            if self.store_file is not None:
+                self.store_file.close()
+
+
+class BarometerTrend(object): # Running least squares fit of pressure against time over a sliding window, updated in O(1) per reading
+    recompute_interval = 1000 # Readings between recalculating the sums from scratch, to stop rounding errors building up
+
+    def __init__(self, length):
+        self.length = length # Seconds
+        self.readings = collections.deque()
+        self.updates = 0
+        self.reset_sums(0.0, 0.0)
+
+    def reset_sums(self, origin_time, origin_pressure): # Times and pressures are summed relative to an origin to keep the sums small
+        self.origin_time = origin_time
+        self.origin_pressure = origin_pressure
+        self.sum_t = self.sum_p = self.sum_tt = self.sum_tp = self.sum_pp = 0.0
+
+    def accumulate(self, reading_time, pressure, sign):
+        t = (reading_time - self.origin_time) / 3600 # Hours, so that slopes are in millibars per hour
+        p = pressure - self.origin_pressure
+        self.sum_t += sign * t
+        self.sum_p += sign * p
+        self.sum_tt += sign * t * t
+        self.sum_tp += sign * t * p
+        self.sum_pp += sign * p * p
+
+    def add_reading(self, reading_time, pressure):
+        if not self.readings:
+            self.reset_sums(reading_time, pressure)
+        self.readings.append((reading_time, pressure))
+        self.accumulate(reading_time, pressure, 1)
+        while self.readings[0][0] < reading_time - self.length:
+            old_time, old_pressure = self.readings.popleft()
+            self.accumulate(old_time, old_pressure, -1)
+        self.updates += 1
+        if self.updates >= self.recompute_interval: # Amortised O(1)
+            self.updates = 0
+            self.reset_sums(self.readings[0][0], self.readings[0][1])
+            for old_time, old_pressure in self.readings:
+                self.accumulate(old_time, old_pressure, 1)
+
+    def coverage(self): # Fraction of the window spanned by the readings
+        if len(self.readings) < 2:
+            return 0.0
+        return (self.readings[-1][0] - self.readings[0][0]) / self.length
+
+    def statistics(self): # Returns the slope in millibars per hour and the variance of the readings around the fitted line, or None
+        n = len(self.readings)
+        if n < 3:
+            return None
+        s_tt = self.sum_tt - self.sum_t * self.sum_t / n
+        if s_tt <= 0:
+            return None
+        s_tp = self.sum_tp - self.sum_t * self.sum_p / n
+        s_pp = self.sum_pp - self.sum_p * self.sum_p / n
+        slope = s_tp / s_tt
+        variance = max(s_pp - slope * s_tp, 0.0) / (n - 2)
+        return slope, variance
+
+
+class BarometerForecaster(object): # Forecasts from pressure trends fitted over all recent readings rather than a single reading from 3 hours ago
+    # The Zambretti style rules from analyse_barometer as interval tables. Each boundary is (threshold, 1 if a value equal to the threshold
+    # belongs to the interval below, otherwise 0), so that bisecting (value, 0.5) finds the interval without a chain of comparisons
+    pressure_boundaries = ((1009, 0), (1015, 1), (1018, 1), (1023, 1))
+    change_tables = (
+        (((-10, 1), (-4, 0), (-1.1, 1), (6, 0), (10, 0)), # Below 1009 millibars
+         ('Storm and Gale', 'Storm', 'Rain and Wind', 'Clearing and Colder', 'Strong Wind Warning', 'Gale Warning')),
+        (((-4, 1), (1.1, 0), (6, 1), (10, 0)), # 1009 to 1015 millibars
+         ('Rain and Wind', 'No Change', 'No Change', 'Strong Wind Warning', 'Gale Warning')),
+        (((-4, 1), (1.1, 0), (6, 1), (10, 0)), # Above 1015 to 1018 millibars
+         ('Rain and Wind', 'No Change', 'Poorer Weather', 'Strong Wind Warning', 'Gale Warning')),
+        (((-4, 1), (-1.1, 1), (0, 1), (1.1, 0), (6, 0), (10, 0)), # Above 1018 to 1023 millibars
+         ('Rain, Wind and Higher Temp', 'No Change and Rain in 24 Hours', 'Fair Weather with Slight Temp Change', 'No Change', 'Poorer Weather',
+          'Strong Wind Warning', 'Gale Warning')),
+        (((-4, 1), (-1.1, 1), (0, 1), (1.1, 0), (6, 0), (10, 0)), # Above 1023 millibars
+         ('Warming Trend', 'Fair Weather and Slowly Rising Temp', 'Fair Weather with No Marked Temp Change', 'Fair Weather', 'Poorer Weather',
+          'Strong Wind Warning', 'Gale Warning')))
+
+    def __init__(self, window_hours=(1, 3, 6), forecast_hours=3, minimum_coverage=0.8, minimum_readings=10):
+        self.lock = threading.Lock()
+        self.trends = {hours: BarometerTrend(hours * 3600) for hours in window_hours}
+        self.forecast_hours = forecast_hours # The window whose trend is classified, as a change over that many hours
+        self.minimum_coverage = minimum_coverage
+        self.minimum_readings = minimum_readings
+
+    def add_reading(self, reading_time, pressure):
+        with self.lock:
+            for trend in self.trends.values():
+                trend.add_reading(reading_time, pressure)
+
+    def trend_statistics(self): # Returns {window hours: (slope in millibars per hour, variance, coverage)} for windows with enough readings
+        with self.lock:
+            statistics = {}
+            for hours, trend in self.trends.items():
+                trend_statistics = trend.statistics()
+                if trend_statistics is not None:
+                    statistics[hours] = trend_statistics + (trend.coverage(),)
+            return statistics
+
+    def pressure_change(self): # Returns the fitted change over forecast_hours, or None until the window has enough readings
+        with self.lock:
+            trend = self.trends[self.forecast_hours]
+            if len(trend.readings) < self.minimum_readings or trend.coverage() < self.minimum_coverage:
+                return None
+            trend_statistics = trend.statistics()
+        if trend_statistics is None:
+            return None
+        return trend_statistics[0] * self.forecast_hours
+
+    @classmethod
+    def classify(cls, barometer, barometer_change):
+        band = bisect.bisect_right(cls.pressure_boundaries, (barometer, 0.5))
+        change_boundaries, forecasts = cls.change_tables[band]
+        return forecasts[bisect.bisect_right(change_boundaries, (barometer_change, 0.5))]
+
+
+class SensorRecord(object): # The state behind one display pixel. Records are held in display buffer index order
+    __slots__ = ('name', 'sensor_class', 'h_s_v', 'last_value', 'last_update')
+
+    def __init__(self):
+        self.name = None
+        self.sensor_class = None
+        self.h_s_v = None # The latest [hue, saturation, brightness]
+        self.last_value = None # The sensor value behind the latest update
+        self.last_update = 0.0
+
+
+class ExpiryScheduler(object): # Min heap of expiry deadlines. Rescheduled entries are left in place and skipped when they reach the top
+    def __init__(self):
+        self.heap = []
+        self.generations = {} # The current generation of each key's deadline
+        self.live_deadlines = 0
+
+    def schedule(self, key, deadline):
+        current_generation = self.generations.get(key, 0)
+        if current_generation > 0: # Replacing a live deadline
+            self.live_deadlines -= 1
+        generation = abs(current_generation) + 1
+        self.generations[key] = generation
+        heapq.heappush(self.heap, (deadline, key, generation))
+        self.live_deadlines += 1
+        if len(self.heap) > 4 * self.live_deadlines + 64: # Drop superseded entries once they dominate the heap. Amortised O(1)
+            self.heap = [entry for entry in self.heap if self.generations.get(entry[1]) == entry[2]]
+            heapq.heapify(self.heap)
+
+    def next_deadline(self): # Returns the earliest live deadline, or None if there isn't one
+        heap = self.heap
+        while heap and self.generations.get(heap[0][1]) != heap[0][2]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def pop_expired(self, now): # Returns the keys whose deadlines have passed
+        expired = []
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            deadline, key, generation = heapq.heappop(heap)
+            if self.generations.get(key) == generation:
+                self.generations[key] = -generation # Negative generations never match a heap entry, until the key is scheduled again
+                self.live_deadlines -= 1
+                expired.append(key)
+        return expired
+
+
+class DomoticzPublisher(object): # Publishes Domoticz updates from its own thread, keeping only the newest pending update for each idx
+    def __init__(self, publish, connected, topic, max_pending=32, retry_delay=1, max_retry_delay=60, send_poll_interval=0.05):
+        self.publish = publish # Called with the topic and payload on the publisher's thread. Returns paho's message info, or None if it can't publish
+        self.connected = connected # Returns whether paho is connected to the broker
+        self.topic = topic
+        self.max_pending = max_pending # The oldest pending update is dropped to make room beyond this many idxs
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.send_poll_interval = send_poll_interval # Seconds between checks while waiting for paho to send an update
+        self.condition = threading.Condition()
+        self.pending = collections.OrderedDict() # Serialised payloads by idx, oldest first
+        self.queued = 0
+        self.coalesced = 0 # Pending updates that were replaced by a newer one for the same idx
+        self.dropped = 0
+        self.published = 0
+        self.failed = 0 # Publish attempts that will be retried
+
+    def queue(self, domoticz_json): # Doesn't block. The payload is serialised straight away, so later changes to domoticz_json aren't published
+        idx = domoticz_json['idx']
+        payload = json.dumps(domoticz_json)
+        with self.condition:
+            self.queued += 1
+            if idx in self.pending:
+                self.coalesced += 1
+            elif len(self.pending) >= self.max_pending:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            self.pending[idx] = payload
+            self.condition.notify()
+
+    def run(self):
+        retry_delay = self.retry_delay
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                idx, payload = next(iter(self.pending.items())) # Left in place until it's published, so that newer updates still replace it
+            try:
+                message_info = self.publish(self.topic, payload)
+                sent = message_info is not None and self.wait_until_sent(message_info)
+            except Exception as error: # Keep the publisher running whatever goes wrong with a publish
+                print('Domoticz Publish Failed', error)
+                sent = False
+            if sent:
+                with self.condition:
+                    if self.pending.get(idx) is payload:
+                        del self.pending[idx]
+                    self.published += 1
+                retry_delay = self.retry_delay
+            else: # Broker is slow or disconnected. Keep coalescing until it's back
+                with self.condition:
+                    self.failed += 1
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, self.max_retry_delay)
+
+    def wait_until_sent(self, message_info): # paho only queues the packet when it publishes, so wait until it's been written to the broker's socket
+        while not message_info.is_published(): # Polled because wait_for_publish only takes a timeout from paho 1.6. Newer updates replace the pending one meanwhile
+            if message_info.rc != mqtt.MQTT_ERR_SUCCESS or not self.connected(): # Not queued, or discarded when paho reconnects
+                return False
+            time.sleep(self.send_poll_interval)
+        return True
+
+    def start(self):
+        threading.Thread(target=self.run, name='domoticz_publisher', daemon=True).start()
+
+    def report(self):
+        with self.condition:
+            return {'pending': len(self.pending), 'queued': self.queued, 'coalesced': self.coalesced, 'dropped': self.dropped,
+                    'published': self.published, 'failed': self.failed}
+
+
+class DisplayMetrics(object): # Counters and timings for monitoring the display while it runs unattended
+    latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0) # Upper bounds in seconds. Slower latencies go in a final overflow bucket
+    frame_rate_window = 60 # Seconds of frame pushes that the frame push rate covers
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.messages_received = {} # By topic
+        self.messages_dispatched = {} # By handler
+        self.messages_ignored = {} # By topic, whether rejected before or after parsing
+        self.latency_histogram = [0 for bucket in range(len(self.latency_buckets)+1)] # Message receipt to framebuffer write
+        self.latency_count = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.frame_pushes = 0
+        self.frame_push_times = collections.deque() # Monotonic times of the pushes within the last frame_rate_window seconds
+        self.barometer_reads = 0
+        self.barometer_read_total = 0.0
+        self.barometer_read_max = 0.0
+
+    def count_message(self, counts, key):
+        with self.lock:
+            counts[key] = counts.get(key, 0) + 1
+
+    def record_latencies(self, latencies):
+        with self.lock:
+            for latency in latencies:
+                bucket = 0
+                while bucket < len(self.latency_buckets) and latency > self.latency_buckets[bucket]:
+                    bucket += 1
+                self.latency_histogram[bucket] += 1
+                self.latency_count += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+
+    def record_frame_push(self):
+        with self.lock:
+            self.frame_pushes += 1
+            push_time = time.monotonic()
+            self.frame_push_times.append(push_time)
+            while self.frame_push_times[0] < push_time - self.frame_rate_window:
+                self.frame_push_times.popleft()
+
+    def record_barometer_read(self, duration):
+        with self.lock:
+            self.barometer_reads += 1
+            self.barometer_read_total += duration
+            self.barometer_read_max = max(self.barometer_read_max, duration)
+
+    def report(self): # Returns the metrics as a dict without changing them, so http and mqtt reports don't affect each other
+        with self.lock:
+            report_time = time.time()
+            window_start = time.monotonic() - self.frame_rate_window
+            window_pushes = sum(1 for push_time in self.frame_push_times if push_time >= window_start)
+            frame_push_rate = window_pushes / max(min(report_time - self.start_time, self.frame_rate_window), 0.001) # Per second over the window, or since start if that's shorter
+            latency_histogram = {('le_' + str(bucket)): count for bucket, count in zip(self.latency_buckets, self.latency_histogram)}
+            latency_histogram['le_inf'] = self.latency_histogram[-1]
+            return {'uptime_seconds': round(report_time - self.start_time), 'messages_received': dict(self.messages_received),
+                    'messages_dispatched': dict(self.messages_dispatched), 'messages_ignored': dict(self.messages_ignored),
+                    'latency_seconds': {'count': self.latency_count, 'mean': self.latency_total/self.latency_count if self.latency_count else 0.0,
+                                        'max': self.latency_max, 'histogram': latency_histogram},
+                    'frame_pushes': self.frame_pushes, 'frame_push_rate': frame_push_rate,
+                    'barometer_read_seconds': {'count': self.barometer_reads, 'max': self.barometer_read_max,
+                                               'mean': self.barometer_read_total/self.barometer_reads if self.barometer_reads else 0.0}}
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler): # Serves the display's metrics report as JSON
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.display.metrics_report()).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # Don't log every request
+        pass
 
 
 class NorthcliffDisplay(object): # The class for the main display code
@@ -18,17 +714,44 @@ class NorthcliffDisplay(object): # The class for the main display code
         self.door_map={'Entry Door':(3,7), 'South Living Room Door':(7,3), 'North Living Room Door':(7,4)}
         self.temp_map={'Living Temperature':(6,5), 'Study Temperature':(2,4), 'Kitchen Temperature':(3,1), 'North Temperature':(1,7), 'South Temperature':(1,1), 'Main Temperature':(5,7),
                           'Rear Balcony Temperature':(0,7), 'North Balcony Temperature':(7,7), 'South Balcony Temperature':(7,1)}
-        self.display_buffer=[[0,0,0] for a in range(64)]
+        self.display_buffer=bytearray(64*3) # Red, green and blue for each pixel, updated in place
+        self.pending_updates={} # Latest [hue, saturation, brightness] for each display buffer index, applied at the next frame push
+        self.coalesced_updates=0 # Pending updates that were replaced before they reached the display
+        self.dirty_pixels=set() # Display buffer indexes that have changed since the last frame push
+        self.low_light_dirty=True # Set the Sense HAT's light level on the first frame push
+        self.display_changed=threading.Event() # Wakes the threaded display loop as soon as there's something to push
+        self.display_lock=threading.RLock() # Keeps paho's network thread and the display loop from interleaving display updates
+        self.asyncio_runtime=False # Set to True to run mqtt, barometer readings and frame pushes on a single asyncio event loop
+        self.event_loop=None
+        self.frame_handle=None # The event loop's pending frame push
+        self.max_frame_rate=20 # Frames per second
+        self.full_frame_threshold=16 # The sense_hat backend pushes the whole frame rather than individual pixels when more pixels than this have changed
+        self.display_rotation=180
+        self.framebuffer_display=False # Set to True to write straight to the Sense HAT's framebuffer rather than through the sense_hat library
+        self.framebuffer_device=None # None finds the Sense HAT's framebuffer. A regular file can stand in for the device when running headless
+        self.display_backend=None
+        self.last_frame_time=0
+        self.barometer_log_interval=1200 # Seconds between barometer log updates
+        self.barometer_read_interval=300 # Seconds between barometer readings without logging
         self.aircon_state_map=(4,4)
         self.aircon_filter_map=(4,5)
         self.hum_map=(7,5)
+        self.hum_sensor_name='North Balcony Humidity'
+        self.lux_sensor_name='Living Lux' # Used to dim the display in low light
         self.aqi_map=(4,2)
         self.outdoor_aqi_map= (0,5)
         self.air_purifier_filter_map={'Living Air Purifier':(4,3), 'Main Air Purifier':(6,6)}
         self.barometer_map=(0,3)
         self.barometer_calibration_offset=-3
         self.barometer_change_map=(0,4)
-        self.barometer_history = [0.00 for x in range (9)]
+        self.barometer_samples=5 # Readings that are median filtered for each barometer sample
+        self.barometer_sample_spacing=0.2 # Seconds between those readings
+        self.barometer_sample_interval=60 # Seconds between barometer samples
+        self.barometer_max_sample_age=2*self.barometer_sample_interval # Older samples are treated as invalid, so a failed sensor isn't logged or published
+        self.barometer_history = [0.00 for x in range (9)] # The latest reading, then readings at each of the previous 8 log intervals
+        self.barometer_store_file=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'NHMDisplay_barometer.bin')
+        self.barometer_store_tiers=((60, 360), (1200, 216), (3600, 720)) # (seconds, buckets) giving 6 hours by minute, 3 days by 20 minutes and 30 days by hour
+        self.barometer_store=None
         self.weather_forecast=[[0,0],[0,0],[0,0]]
         self.wind_forecast_map=(0,0)
         self.rain_forecast_map=(0,1)
@@ -43,55 +766,168 @@ class NorthcliffDisplay(object): # The class for the main display code
         self.domoticz_barometer_format={'idx':767,'nvalue':0}
         self.domoticz_barometer_level='0'
         self.domoticz_barometer_forecast='0'
+        self.domoticz_publisher=DomoticzPublisher(self.publish_domoticz, self.mqtt_connected, self.domoticz_incoming_mqtt_topic)
         self.aquarium_ph_map=(5,0)
         self.aquarium_nh3_map=(5,1)
         self.aquarium_temp_map=(5,2)
         self.aquarium_idx_map={'ph':769,'nh3':770,'temp':772}
         self.low_light=False
-     
+        self.hsv_lut_step=10 # Saturation and brightness levels held in the HSV lookup table. Other levels are calculated directly
+        self.hsv_lut_cache_file=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'NHMDisplay_hsv_lut.bin')
+        self.hsv_lut=HSVLookupTable(self.hsv_lut_step, self.hsv_lut_cache_file)
+        self.metrics_enabled=False # Set to True to collect message, latency, frame and barometer metrics
+        self.metrics_http_address='127.0.0.1'
+        self.metrics_http_port=None # Set to a port number to serve the metrics as JSON over http
+        self.metrics_mqtt_topic=None # Set to an mqtt topic to publish the metrics to
+        self.metrics_publish_interval=60 # Seconds
+        self.metrics=DisplayMetrics() if self.metrics_enabled else None
+        self.barometer_sampler=BarometerSampler(self.read_barometer, self.barometer_samples, self.barometer_sample_spacing, self.barometer_sample_interval)
+        self.barometer_sampler.sample_listeners.append(self.store_barometer_sample)
+        self.barometer_forecaster=BarometerForecaster()
+        self.barometer_sampler.sample_listeners.append(self.barometer_forecaster.add_reading)
+        self.message_receipt_time=None # When the message being handled arrived, for latency metrics
+        self.pending_receipt_times={} # When the earliest message behind each pending update arrived
+        self.source_value=None # The sensor value behind the update being handled
+        self.snapshot_file=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'NHMDisplay_snapshot.bin')
+        self.snapshot_interval=60 # Seconds between saving the display state, if it has changed
+        self.snapshot_max_age=3600 # Restored pixels older than this many seconds are dimmed or blanked
+        self.snapshot_stale_action='dim' # 'dim' or 'blank'
+        self.snapshot_dim_brightness=20
+        self.snapshot_due=False # Set when the display state has changed since the last snapshot
+        self.sensor_ttls={'motion': 86400, 'door': 86400, 'temperature': 3600, 'humidity': 3600, 'aquarium': 3600, 'air_quality': 3600,
+                          'barometer': 3600, 'aircon': None, 'air_purifier_filter': None} # Seconds without an update before a pixel is stale. None never expires
+        self.stale_brightness=20 # Stale pixels keep their hue and saturation at this brightness, so pixels that were off show as dim white
+        self.expiry_scheduler=ExpiryScheduler()
+        self.expiry_handle=None # The event loop's pending expiry check
+        self.expiry_handle_deadline=None
+        self.stale_pixels=set()
+        self.display_role='standalone' # 'standalone', 'leader' to also publish the composed frame for other displays, or 'follower' to only show the leader's frame
+        self.frame_mqtt_topic='homemanager/display/frame' # Retained full frames
+        self.frame_delta_mqtt_topic='homemanager/display/frame/delta' # The pixels that changed in each frame push
+        self.full_frame_interval=5 # Seconds. The retained full frame is brought up to date at most this often, unless a delta would be as big as a full frame
+        self.frame_session=int.from_bytes(os.urandom(4), 'little') # Lets followers tell the leader's restarts apart. Followers adopt the leader's session
+        self.frame_sequence=0 # Counts the leader's frame changes, so followers can tell when they've missed a delta
+        self.frame_publishing=False # Set when a leader connects to the broker
+        self.full_frame_due=False # Set when deltas have been published since the last full frame
+        self.compile_sensor_registry()
+        self.compile_message_router()
+
     def on_connect(self, client, userdata, flags, rc):
         # Sets up the mqtt subscriptions. Subscribing in on_connect() means that if we lose the connection and reconnect then subscriptions will be renewed.
         self.print_update('Northcliff Home Manager Display Connected with result code '+str(rc)+' on ')
+        if self.display_role=='follower':
+            client.subscribe(self.frame_mqtt_topic) # The retained full frame arrives straight away
+            client.subscribe(self.frame_delta_mqtt_topic)
+            return
         client.subscribe(self.homebridge_outgoing_mqtt_topic) # Subscribe to mqtt messages from Home Manager to Homebridge
         client.subscribe(self.domoticz_incoming_mqtt_topic) # Subscribe to mqtt messages from Home Manager to Domoticz
+        if self.display_role=='leader':
+            self.frame_publishing=True
+            self.publish_full_frame() # Brings the retained frame up to date after a restart or reconnection
     
     def on_message(self, client, userdata, msg):
         # Calls the relevant methods for the display, based on the mqtt publish messages received from the Home Manager
-        decoded_payload = str(msg.payload.decode("utf-8"))
-        parsed_json = json.loads(decoded_payload)
-        if msg.topic == self.homebridge_outgoing_mqtt_topic: # If it's a Homebridge message coming from Home Manager
-            #print(parsed_json)
-            if 'Air Purifier' in parsed_json['name'] and parsed_json['characteristic']=='FilterChangeIndication':
-                self.process_air_purifier_filter(parsed_json)
-            elif parsed_json['name']=='Indoor AQI' and parsed_json['characteristic']=='AirQuality':
-                self.process_aqi(parsed_json)
-            elif parsed_json['name']=='Outdoor AQI' and parsed_json['characteristic']=='AirQuality':
-                self.process_outdoor_aqi(parsed_json)
-            elif 'Aircon' in parsed_json['name']:
-                self.process_aircon(parsed_json)
-            elif ' Motion' in parsed_json['service_name'] and parsed_json['characteristic']=='MotionDetected':
-                self.process_motion(parsed_json)
-            elif ' Door' in parsed_json['service_name'] and parsed_json['characteristic']=='ContactSensorState':
-                self.process_door(parsed_json)
-            elif ' Temperature' in parsed_json['service_name'] and parsed_json['characteristic']=='CurrentTemperature':
-                self.process_temp(parsed_json)
-            elif ' Humidity' in parsed_json['service_name'] and parsed_json['characteristic']=='CurrentRelativeHumidity':
-                self.process_hum(parsed_json)
-            elif parsed_json['service_name']=='Living Lux' and parsed_json['characteristic']=='CurrentAmbientLightLevel':
-                self.process_lux(parsed_json)
-            else:
-                #print("Ignored json", parsed_json)
-                pass
-        elif msg.topic == self.domoticz_incoming_mqtt_topic: # If it's a message sent to Domoticz
-            #print('Received Domoticz In Message', parsed_json)
-            aquarium_idx_found=False
-            for sensor in self.aquarium_idx_map:
-                if parsed_json['idx']==self.aquarium_idx_map[sensor]:
-                    aquarium_idx_found=True
-            if aquarium_idx_found:
-                self.process_aquarium(parsed_json)
+        metrics = self.metrics
+        if metrics is not None:
+            receipt_time = time.monotonic()
+            metrics.count_message(metrics.messages_received, msg.topic)
+        route = self.topic_routes.get(msg.topic)
+        if route is None:
+            return # Ignore other messages
+        payload_filter, route_message = route
+        if not payload_filter(msg.payload): # Can't be a displayed sensor, so don't bother parsing it
+            self.messages_skipped_early[msg.topic] += 1
+            if metrics is not None:
+                metrics.count_message(metrics.messages_ignored, msg.topic)
+            return
+        parsed_json = json_loads(msg.payload)
+        handler = route_message(parsed_json)
+        if handler is not None:
+            with self.display_lock:
+                if metrics is not None:
+                    metrics.count_message(metrics.messages_dispatched, handler.__name__)
+                    self.message_receipt_time = receipt_time
+                self.source_value = parsed_json.get('value', parsed_json.get('svalue'))
+                try:
+                    handler(parsed_json)
+                finally:
+                    self.message_receipt_time = None
+                    self.source_value = None
         else:
-            pass # Ignore other messages    
+            #print("Ignored json", parsed_json)
+            if metrics is not None:
+                metrics.count_message(metrics.messages_ignored, msg.topic)
+
+    def compile_sensor_registry(self): # Builds a record for each pixel, named and classed from the sensor maps
+        self.sensors=[SensorRecord() for index in range(64)]
+        sensor_maps=[('motion', self.motion_map), ('door', self.door_map), ('temperature', self.temp_map), ('air_purifier_filter', self.air_purifier_filter_map),
+                     ('aircon', {'Aircon State': self.aircon_state_map, 'Aircon Filter': self.aircon_filter_map}), ('humidity', {self.hum_sensor_name: self.hum_map}),
+                     ('air_quality', {'Indoor AQI': self.aqi_map, 'Outdoor AQI': self.outdoor_aqi_map}),
+                     ('aquarium', {'Aquarium ph': self.aquarium_ph_map, 'Aquarium nh3': self.aquarium_nh3_map, 'Aquarium Temperature': self.aquarium_temp_map}),
+                     ('barometer', {'Barometer': self.barometer_map, 'Barometer Change': self.barometer_change_map, 'Wind Forecast': self.wind_forecast_map,
+                                    'Rain Forecast': self.rain_forecast_map, 'Temperature Forecast': self.temp_forecast_map})]
+        for sensor_class, sensor_map in sensor_maps:
+            for sensor_name in sensor_map:
+                sensor=self.sensors[sensor_map[sensor_name][0]+sensor_map[sensor_name][1]*8]
+                sensor.name=sensor_name
+                sensor.sensor_class=sensor_class
+
+    def compile_message_router(self): # Builds the lookup tables that on_message uses to find the handler for each message
+        self.homebridge_name_routes={} # Keyed by (name, characteristic)
+        for name in self.air_purifier_filter_map:
+            self.homebridge_name_routes[(name, 'FilterChangeIndication')]=self.process_air_purifier_filter
+        self.homebridge_name_routes[('Indoor AQI', 'AirQuality')]=self.process_aqi
+        self.homebridge_name_routes[('Outdoor AQI', 'AirQuality')]=self.process_outdoor_aqi
+        self.homebridge_service_routes={} # Keyed by (service_name, characteristic)
+        for service_name in self.motion_map:
+            self.homebridge_service_routes[(service_name, 'MotionDetected')]=self.process_motion
+        for service_name in self.door_map:
+            self.homebridge_service_routes[(service_name, 'ContactSensorState')]=self.process_door
+        for service_name in self.temp_map:
+            self.homebridge_service_routes[(service_name, 'CurrentTemperature')]=self.process_temp
+        self.homebridge_service_routes[(self.hum_sensor_name, 'CurrentRelativeHumidity')]=self.process_hum
+        self.homebridge_service_routes[(self.lux_sensor_name, 'CurrentAmbientLightLevel')]=self.process_lux
+        self.aircon_names={} # Aircon accessory names aren't fixed, so each name is only substring matched the first time it's seen
+        self.domoticz_idx_routes={}
+        for sensor in self.aquarium_idx_map:
+            self.domoticz_idx_routes[self.aquarium_idx_map[sensor]]=self.process_aquarium
+        # Every routable Homebridge payload has a routed name or service name, or contains an aircon name
+        self.homebridge_payload_names=set(name.encode() for name, characteristic in self.homebridge_name_routes)
+        self.homebridge_payload_names.update(service_name.encode() for service_name, characteristic in self.homebridge_service_routes)
+        self.homebridge_payload_pattern=re.compile(rb'"(?:name|service_name)"\s*:\s*"([^"\\]*)"')
+        self.domoticz_payload_pattern=re.compile(rb'"idx"\s*:\s*(\d+)')
+        self.topic_routes={self.homebridge_outgoing_mqtt_topic: (self.filter_homebridge_payload, self.route_homebridge_message),
+                           self.domoticz_incoming_mqtt_topic: (self.filter_domoticz_payload, self.route_domoticz_message)}
+        self.messages_skipped_early={topic: 0 for topic in self.topic_routes} # Messages rejected before JSON parsing, by topic
+
+    def route_homebridge_message(self, parsed_json): # Returns the handler for a Homebridge message from Home Manager or None if it's not displayed
+        name = parsed_json.get('name')
+        characteristic = parsed_json.get('characteristic')
+        handler = self.homebridge_name_routes.get((name, characteristic))
+        if handler is not None:
+            return handler
+        aircon = self.aircon_names.get(name)
+        if aircon is None:
+            aircon = isinstance(name, str) and 'Aircon' in name
+            self.aircon_names[name] = aircon
+        if aircon:
+            return self.process_aircon
+        return self.homebridge_service_routes.get((parsed_json.get('service_name'), characteristic))
+
+    def filter_homebridge_payload(self, payload): # Checks the raw payload's names and service names
+        if b'Aircon' in payload:
+            return True
+        for name in self.homebridge_payload_pattern.findall(payload):
+            if name in self.homebridge_payload_names:
+                return True
+        return False
+
+    def filter_domoticz_payload(self, payload): # Checks the raw payload for a displayed idx
+        idx_match = self.domoticz_payload_pattern.search(payload)
+        return idx_match is not None and int(idx_match.group(1)) in self.domoticz_idx_routes
+
+    def route_domoticz_message(self, parsed_json): # Returns the handler for a message sent to Domoticz or None if it's not displayed
+        return self.domoticz_idx_routes.get(parsed_json.get('idx'))
 
     def process_air_purifier_filter(self, parsed_json):
         if parsed_json['value']==1: # Filter needs changing
@@ -155,7 +991,7 @@ class NorthcliffDisplay(object): # The class for the main display code
         self.load_display_buffer(self.temp_map[parsed_json['service_name']][0], self.temp_map[parsed_json['service_name']][1], [hue,100,100])
 
     def process_hum(self, parsed_json):
-        if parsed_json['service_name']=='North Balcony Humidity':
+        if parsed_json['service_name']==self.hum_sensor_name:
             #print('Humidity', parsed_json, self.hum_map[0], self.hum_map[1])
             hue=int(parsed_json['value']*2.4)
             self.load_display_buffer(self.hum_map[0], self.hum_map[1], [hue,100,100])
@@ -175,13 +1011,34 @@ class NorthcliffDisplay(object): # The class for the main display code
 
     def process_lux(self, parsed_json):
         #print('Living Light Level', parsed_json)
-        if parsed_json['value']<40:
-            self.low_light=True
-        else:
-            self.low_light=False
+        low_light = parsed_json['value']<40
+        if low_light != self.low_light:
+            self.low_light=low_light
+            self.low_light_dirty=True
+            self.snapshot_due=True
+            self.request_frame()
+
+    def read_barometer(self): # Blocking I2C read. Only called from the barometer sampler's thread
+        if self.metrics is None:
+            return round(sense.get_pressure(),2)+self.barometer_calibration_offset
+        read_start_time=time.monotonic()
+        pressure=sense.get_pressure()
+        self.metrics.record_barometer_read(time.monotonic() - read_start_time)
+        return round(pressure,2)+self.barometer_calibration_offset
 
-    def process_barometer(self, log):
-        barometer=round(sense.get_pressure(),2)+self.barometer_calibration_offset
+    def process_barometer(self, log, barometer=None): # Uses the barometer sampler's latest reading unless one is given
+        if barometer is None:
+            barometer, sample_time=self.barometer_sampler.latest()
+            if barometer is None or time.time() - sample_time > self.barometer_max_sample_age:
+                barometer=0 # Invalid
+        with self.display_lock:
+            self.source_value=barometer
+            try:
+                return self.process_barometer_reading(log, barometer)
+            finally:
+                self.source_value=None
+
+    def process_barometer_reading(self, log, barometer):
         if barometer>500: # Only record valid barometer readings. Caters for startup mode
             valid_barometer_reading=True
             barometer_reading_time=time.time()
@@ -200,20 +1057,19 @@ class NorthcliffDisplay(object): # The class for the main display code
                 if valid_barometer_history == True:
                     self.process_barometer_change(barometer_change, barometer)
                 else:
-                    domoticz_json = self.domoticz_barometer_format
-                    domoticz_json['svalue'] = self.domoticz_barometer + ';' + self.domoticz_barometer_forecast
-                    client.publish(self.domoticz_incoming_mqtt_topic, json.dumps(domoticz_json))
+                    self.queue_domoticz_barometer()
                 return valid_barometer_reading, barometer_log_time, barometer_reading_time
             else:
-               domoticz_json = self.domoticz_barometer_format
-               domoticz_json['svalue'] = self.domoticz_barometer + ';' + self.domoticz_barometer_forecast
-               client.publish(self.domoticz_incoming_mqtt_topic, json.dumps(domoticz_json))
+               self.queue_domoticz_barometer()
                return valid_barometer_reading, barometer_reading_time
-        else:
+        else: # Nothing is displayed, logged or published. Both the reading and the log are tried again after the read interval
             valid_barometer_reading=False
-            barometer_log_time = 0
-            barometer_reading_time = 0
-        return valid_barometer_reading, barometer_log_time, barometer_reading_time
+            self.print_update('No Valid Barometer Reading on ')
+            barometer_reading_time=time.time()
+            if log == True:
+                barometer_log_time=barometer_reading_time - self.barometer_log_interval + self.barometer_read_interval
+                return valid_barometer_reading, barometer_log_time, barometer_reading_time
+            return valid_barometer_reading, barometer_reading_time
 
 
     def process_aquarium(self,parsed_json):
@@ -251,19 +1107,35 @@ class NorthcliffDisplay(object): # The class for the main display code
         else:
             pass
             
-    def log_barometer(self, barometer): # Logs 3 hours of barometer readings, taken every 18 minutes
-        three_hour_barometer=self.barometer_history[8] # Capture barometer reading from 3 hours ago
-        for pointer in range (8, 0, -1): # Move previous temperatures one position in the list to prepare for new temperature to be recorded
-            self.barometer_history[pointer] = self.barometer_history[pointer - 1]
-        self.barometer_history[0] = barometer # Log latest reading
-        if three_hour_barometer!=0:
+    def open_barometer_store(self): # Falls back to an in memory store if the file can't be used
+        try:
+            self.barometer_store=BarometerStore(self.barometer_store_file, self.barometer_store_tiers)
+        except OSError as error:
+            print('Unable to open barometer store', error)
+            self.barometer_store=BarometerStore(None, self.barometer_store_tiers)
+        finest_resolution=self.barometer_store_tiers[0][0]
+        longest_trend=max(self.barometer_forecaster.trends)*3600
+        for reading_time, barometer in self.barometer_store.readings(time.time() - longest_trend, finest_resolution): # Warm start the forecaster
+            self.barometer_forecaster.add_reading(reading_time, barometer)
+
+    def store_barometer_sample(self, sample_time, barometer):
+        if self.barometer_store is not None:
+            self.barometer_store.add_reading(sample_time, barometer)
+
+    def log_barometer(self, barometer): # The 3 hour change comes from the forecaster's trend over every reading in the last 3 hours
+        log_time=time.time()
+        tolerance=self.barometer_log_interval/2
+        self.barometer_history=[barometer]+[self.barometer_store.pressure_at(log_time - pointer*self.barometer_log_interval, tolerance) or 0.00 for pointer in range(1, 9)]
+        barometer_change=self.barometer_forecaster.pressure_change()
+        if barometer_change is not None:
             valid_barometer_history = True
-            barometer_change = barometer - three_hour_barometer
         else:
             valid_barometer_history=False
             barometer_change = 0
         self.print_update("Log Barometer on ")
         print("Result", self.barometer_history,valid_barometer_history, round(barometer_change,2))
+        for hours, (slope, variance, coverage) in sorted(self.barometer_forecaster.trend_statistics().items()):
+            print(str(hours)+' hour trend', round(slope, 3), 'millibars per hour, variance', round(variance, 4), 'coverage', round(coverage, 2))
         return valid_barometer_history, barometer_change
 
     def process_barometer_change(self, barometer_change, barometer):
@@ -279,139 +1151,484 @@ class NorthcliffDisplay(object): # The class for the main display code
         self.load_display_buffer(self.rain_forecast_map[0], self.rain_forecast_map[1], [led_forecast[1][0],led_forecast[1][1],100])
         self.load_display_buffer(self.temp_forecast_map[0], self.temp_forecast_map[1], [led_forecast[2][0],led_forecast[2][1],100])
         self.domoticz_barometer_forecast=domoticz_forecast
-        domoticz_json = self.domoticz_barometer_format
-        domoticz_json['svalue'] = self.domoticz_barometer +';'+self.domoticz_barometer_forecast
-        client.publish(self.domoticz_incoming_mqtt_topic, json.dumps(domoticz_json))
+        self.queue_domoticz_barometer()
         self.print_update('3 hour barometer change is '+str(round(barometer_change,1))+' millibars with a current reading of '+str(round(barometer,1))+' millibars. The weather forecast is "'+forecast+'" on ') 
 
+    def queue_domoticz_barometer(self): # Publishes a copy of domoticz_barometer_format, so that the shared format is never changed
+        self.domoticz_publisher.queue(dict(self.domoticz_barometer_format, svalue=self.domoticz_barometer + ';' + self.domoticz_barometer_forecast))
+
+    def publish_domoticz(self, topic, payload): # Called on the Domoticz publisher's thread. Returns paho's message info, or None if the broker isn't connected
+        if self.event_loop is not None: # paho has to be called on the event loop that's servicing its socket
+            return asyncio.run_coroutine_threadsafe(self.publish_domoticz_async(topic, payload), self.event_loop).result()
+        return client.publish(topic, payload) if client.is_connected() else None
+
+    async def publish_domoticz_async(self, topic, payload):
+        return client.publish(topic, payload) if client.is_connected() else None
+
+    def mqtt_connected(self):
+        return client.is_connected()
+
     def analyse_barometer(self, barometer_change, barometer, forecast_barometer_map):
-        led_forecast=[[0,0],[0,0],[0,0]]
-        if barometer<1009:
-            if barometer_change>-1.1 and barometer_change<6:
-                forecast = 'Clearing and Colder'
-            elif barometer_change>=6 and barometer_change<10:
-                forecast = 'Strong Wind Warning'
-            elif barometer_change>=10:
-                forecast = 'Gale Warning'
-            elif barometer_change<=-1.1 and barometer_change>=-4:
-                forecast = 'Rain and Wind'
-            elif barometer_change<-4 and barometer_change>-10:
-                forecast = 'Storm'
-            else:
-                forecast = 'Storm and Gale'
-        elif barometer>=1009 and barometer <=1018:
-            if barometer_change>-4 and barometer_change<1.1:
-                forecast = 'No Change'
-            elif barometer_change>=1.1 and barometer_change<=6 and barometer<=1015:
-                forecast = 'No Change'
-            elif barometer_change>=1.1 and barometer_change<=6 and barometer>1015:
-                forecast = 'Poorer Weather'
-            elif barometer_change>=6 and barometer_change<10:
-                forecast = 'Strong Wind Warning'
-            elif barometer_change>=10:
-                forecast = 'Gale Warning'       
-            else:
-                forecast = 'Rain and Wind'
-        elif barometer>1018 and barometer <=1023:
-            if barometer_change>0 and barometer_change<1.1:
-                forecast = 'No Change'
-            elif barometer_change>=1.1 and barometer_change<6:
-                forecast = 'Poorer Weather'
-            elif barometer_change>=6 and barometer_change<10:
-                forecast = 'Strong Wind Warning'
-            elif barometer_change>=10:
-                forecast = 'Gale Warning'
-            elif barometer_change>-1.1 and barometer_change<=0:
-                forecast = 'Fair Weather with Slight Temp Change'
-            elif barometer_change<=-1.1 and barometer_change>-4:
-                forecast = 'No Change and Rain in 24 Hours'
-            else:
-                forecast = 'Rain, Wind and Higher Temp'
-        else: # barometer>1023
-            if barometer_change>0 and barometer_change<1.1:
-                forecast = 'Fair Weather'
-            elif barometer_change>-1.1 and barometer_change<=0:
-                forecast = 'Fair Weather with No Marked Temp Change'
-            elif barometer_change>=1.1 and barometer_change<6:
-                forecast = 'Poorer Weather'
-            elif barometer_change>=6 and barometer_change<10:
-                forecast = 'Strong Wind Warning'
-            elif barometer_change>=10:
-                forecast = 'Gale Warning'    
-            elif barometer_change<=-1.1 and barometer_change>-4:
-                forecast = 'Fair Weather and Slowly Rising Temp'
-            else:
-                forecast = 'Warming Trend'
+        forecast=BarometerForecaster.classify(barometer, barometer_change)
         led_forecast=forecast_barometer_map[forecast][0]
         domoticz_forecast=forecast_barometer_map[forecast][1]
         return led_forecast, forecast, domoticz_forecast
 
-    def load_display_buffer(self,x,y,h_s_v):
-        red,green,blue=self.set_led_colour(h_s_v[0], h_s_v[1], h_s_v[2])
-        #print("Display Buffer Update", x, y, "HSV:", h_s_v, "RGB", (red,green,blue))
-        self.display_buffer[x+y*8]=(red,green,blue)
+    def load_display_buffer(self,x,y,h_s_v): # Queues the update. Only the latest update for each pixel is converted and displayed
+        #print("Display Buffer Update", x, y, "HSV:", h_s_v)
+        index=x+y*8
+        sensor=self.sensors[index]
+        sensor.h_s_v=h_s_v
+        sensor.last_value=self.source_value
+        sensor.last_update=time.time()
+        self.snapshot_due=True
+        self.stale_pixels.discard(index)
+        self.schedule_expiry(index, sensor.last_update)
+        if self.message_receipt_time is not None and index not in self.pending_receipt_times:
+            self.pending_receipt_times[index]=self.message_receipt_time
+        if index in self.pending_updates:
+            self.coalesced_updates+=1
+            self.pending_updates[index]=h_s_v
+        else:
+            self.pending_updates[index]=h_s_v
+            self.request_frame()
+
+    def apply_pending_updates(self): # Converts each pending update once and flags the pixels that have actually changed
+        pending_updates=self.pending_updates
+        self.pending_updates={}
+        display_buffer=self.display_buffer
+        for index, (red, green, blue) in zip(pending_updates, self.set_led_colours(pending_updates.values())):
+            offset=index*3
+            if display_buffer[offset]!=red or display_buffer[offset+1]!=green or display_buffer[offset+2]!=blue:
+                display_buffer[offset]=red
+                display_buffer[offset+1]=green
+                display_buffer[offset+2]=blue
+                self.dirty_pixels.add(index)
 
-    def drive_display(self):
-        sense.low_light=self.low_light
-        sense.set_pixels(self.display_buffer)                                
+    def schedule_expiry(self, index, update_time):
+        ttl=self.sensor_ttls.get(self.sensors[index].sensor_class)
+        if ttl is None:
+            return
+        deadline=update_time + ttl
+        self.expiry_scheduler.schedule(index, deadline)
+        if self.event_loop is not None and (self.expiry_handle_deadline is None or deadline < self.expiry_handle_deadline):
+            self.arm_expiry_timer()
 
-    def set_led_colour(self, hue_value, saturation_value, brightness):
-        c_value = (brightness/100) * (saturation_value/100)
-        x_value = c_value * (1-abs((hue_value/60) % 2 - 1))
-        m_value = brightness/100 - c_value
-        if (hue_value >= 0 and hue_value < 60):
-            red_value = c_value
-            green_value = x_value
-            blue_value = 0
-        elif (hue_value >= 60  and hue_value < 120):
-            red_value = x_value
-            green_value = c_value
-            blue_value = 0
-        elif (hue_value >= 120  and hue_value < 180):
-            red_value = 0
-            green_value = c_value
-            blue_value = x_value
-        elif (hue_value >= 180  and hue_value < 240):
-            red_value = 0
-            green_value = x_value
-            blue_value = c_value
-        elif (hue_value >= 240  and hue_value < 300):
-            red_value = x_value
-            green_value = 0
-            blue_value = c_value
-        elif (hue_value >= 300  and hue_value < 360):
-            red_value = c_value
-            green_value = 0
-            blue_value = x_value
+    def arm_expiry_timer(self): # Schedules the event loop's next expiry check for the earliest deadline
+        if self.expiry_handle is not None:
+            self.expiry_handle.cancel()
+            self.expiry_handle=None
+            self.expiry_handle_deadline=None
+        next_deadline=self.expiry_scheduler.next_deadline()
+        if next_deadline is not None:
+            self.expiry_handle=self.event_loop.call_later(max(0, next_deadline - time.time()), self.expire_stale_pixels_async)
+            self.expiry_handle_deadline=next_deadline
+
+    def expire_stale_pixels_async(self):
+        self.expiry_handle=None
+        self.expiry_handle_deadline=None
+        self.expire_stale_pixels()
+        self.arm_expiry_timer()
+
+    def expire_stale_pixels(self): # Dims pixels whose sensors haven't updated within their class's time to live
+        with self.display_lock:
+            expired_pixels=self.expiry_scheduler.pop_expired(time.time())
+            if not expired_pixels:
+                return
+            for index in expired_pixels:
+                self.stale_pixels.add(index)
+                hue, saturation, brightness=self.sensors[index].h_s_v
+                self.pending_updates[index]=[hue, saturation, self.stale_brightness]
+            self.request_frame()
+            stale_sensors=[self.sensors[index].name or str(index) for index in expired_pixels]
+        self.print_update('Stale sensors '+', '.join(sorted(stale_sensors))+' ('+str(len(self.stale_pixels))+' stale in total) on ')
+
+    def staleness_report(self):
+        with self.display_lock:
+            return {'stale_pixels': len(self.stale_pixels),
+                    'stale_sensors': sorted(self.sensors[index].name or str(index) for index in self.stale_pixels)}
+
+    def request_frame(self): # Wakes whichever runtime is driving the display
+        if self.event_loop is None:
+            self.display_changed.set()
+        elif self.frame_handle is None: # Schedule a push on the event loop unless one is already pending
+            frame_delay=max(0, self.last_frame_time + 1/self.max_frame_rate - time.time())
+            self.frame_handle=self.event_loop.call_later(frame_delay, self.push_frame)
+
+    def push_frame(self):
+        self.frame_handle=None
+        self.drive_display()
+
+    def drive_display(self): # Pushes only what has changed since the last push
+        frame_message=None
+        with self.display_lock:
+            self.apply_pending_updates()
+            low_light_changed=self.low_light_dirty
+            if low_light_changed:
+                self.low_light_dirty=False
+                self.display_backend.set_low_light(self.low_light)
+            dirty_pixels=self.dirty_pixels
+            if dirty_pixels:
+                self.dirty_pixels=set()
+                self.display_backend.write_pixels(self.display_buffer, dirty_pixels)
+                if self.metrics is not None:
+                    self.metrics.record_frame_push()
+            if self.pending_receipt_times:
+                write_time=time.monotonic()
+                self.metrics.record_latencies([write_time - receipt_time for receipt_time in self.pending_receipt_times.values()])
+                self.pending_receipt_times={}
+            if self.frame_publishing and (dirty_pixels or low_light_changed):
+                frame_message=self.compose_frame_delta(dirty_pixels)
+            self.last_frame_time=time.time()
+        if frame_message is not None: # Published outside the display lock because paho takes its own locks, some of which it holds while calling on_message
+            client.publish(*frame_message)
+
+    frame_message_header = struct.Struct('<4sBIIB') # Magic, full frame flag, leader session, sequence number and low light
+    frame_message_magic = b'NHMF' # A full frame is followed by red, green and blue for all 64 pixels, and a delta by index, red, green and blue for each changed pixel
+
+    def compose_full_frame(self): # Returns the publish arguments for a retained full frame. Called under the display lock
+        self.full_frame_due=False
+        header=self.frame_message_header.pack(self.frame_message_magic, 1, self.frame_session, self.frame_sequence, self.low_light)
+        return self.frame_mqtt_topic, header + bytes(self.display_buffer), 0, True
+
+    def compose_frame_delta(self, dirty_pixels): # Returns the publish arguments for the pixels that have changed. Called under the display lock
+        self.frame_sequence=(self.frame_sequence + 1) & 0xffffffff
+        if len(dirty_pixels)*4 >= len(self.display_buffer): # A full frame is no bigger, and brings the retained frame up to date
+            return self.compose_full_frame()
+        self.full_frame_due=True
+        display_buffer=self.display_buffer
+        delta=bytearray(self.frame_message_header.pack(self.frame_message_magic, 0, self.frame_session, self.frame_sequence, self.low_light))
+        for index in sorted(dirty_pixels):
+            delta.append(index)
+            delta+=display_buffer[index*3:index*3+3]
+        return self.frame_delta_mqtt_topic, bytes(delta), 0, False
+
+    def publish_full_frame(self):
+        with self.display_lock:
+            frame_message=self.compose_full_frame()
+        client.publish(*frame_message)
+
+    def publish_full_frames_periodically(self):
+        while True:
+            time.sleep(self.full_frame_interval)
+            if self.full_frame_due:
+                self.publish_full_frame()
+
+    async def publish_full_frames_periodically_async(self):
+        while True:
+            await asyncio.sleep(self.full_frame_interval)
+            if self.full_frame_due:
+                self.publish_full_frame()
+
+    def start_frame_publishing(self):
+        if self.display_role!='leader':
+            return
+        if self.event_loop is None:
+            threading.Thread(target=self.publish_full_frames_periodically, name='full_frames', daemon=True).start()
         else:
-            pass
-        red = int((red_value + m_value) * 255)
-        green = int((green_value + m_value) * 255)
-        blue = int((blue_value + m_value) * 255)
-        #print(red,green,blue)
-        return red,green,blue
+            self.event_loop.create_task(self.publish_full_frames_periodically_async())
+
+    def on_frame_message(self, client, userdata, msg): # Follower mode. Blits the leader's full frames and deltas into the display buffer
+        payload=msg.payload
+        header_size=self.frame_message_header.size
+        if len(payload) < header_size:
+            return
+        magic, full_frame, session, sequence, low_light=self.frame_message_header.unpack_from(payload)
+        if magic!=self.frame_message_magic:
+            return
+        if self.metrics is not None:
+            self.metrics.count_message(self.metrics.messages_received, msg.topic)
+        with self.display_lock:
+            if full_frame:
+                if len(payload)!=header_size + 192:
+                    return
+                if session==self.frame_session and sequence < self.frame_sequence: # Older than the deltas that have already been applied
+                    return
+                updates=[(index, payload[offset:offset+3]) for index, offset in enumerate(range(header_size, header_size + 192, 3))]
+            else:
+                if session!=self.frame_session or sequence!=(self.frame_sequence + 1) & 0xffffffff: # A delta has been missed, so wait for the next full frame
+                    return
+                if (len(payload) - header_size) % 4:
+                    return
+                updates=[(payload[offset], payload[offset+1:offset+4]) for offset in range(header_size, len(payload), 4) if payload[offset] < 64]
+            self.frame_session=session
+            self.frame_sequence=sequence
+            display_buffer=self.display_buffer
+            for index, rgb in updates:
+                offset=index*3
+                if display_buffer[offset:offset+3]!=rgb:
+                    display_buffer[offset:offset+3]=rgb
+                    self.dirty_pixels.add(index)
+            if bool(low_light)!=self.low_light:
+                self.low_light=bool(low_light)
+                self.low_light_dirty=True
+            if self.dirty_pixels or self.low_light_dirty:
+                self.request_frame()
+
+    def mqtt_queue_depth(self): # Outgoing packets and in flight messages waiting in paho's queues
+        out_packets=getattr(client, '_out_packet', ())
+        out_messages=getattr(client, '_out_messages', ())
+        return {'out_packets': len(out_packets), 'out_messages': len(out_messages)}
+
+    def metrics_report(self):
+        report=self.metrics.report()
+        report['messages_skipped_early']=dict(self.messages_skipped_early)
+        report['coalesced_updates']=self.coalesced_updates
+        report['mqtt_queue_depth']=self.mqtt_queue_depth()
+        report['staleness']=self.staleness_report()
+        report['domoticz_queue']=self.domoticz_publisher.report()
+        return report
+
+    snapshot_header = struct.Struct('<8sdB') # Magic, snapshot time and low light, followed by a record for each pixel and a CRC32
+    snapshot_pixel = struct.Struct('<dHBBd') # Update time (0 if never set), hue, saturation, brightness and sensor value (NaN if not numeric)
+
+    def save_snapshot(self): # Saves every pixel's state so that the display can be restored straight after a restart
+        with self.display_lock:
+            self.snapshot_due=False
+            snapshot=bytearray(self.snapshot_header.pack(b'NHMSNAP1', time.time(), self.low_light))
+            for sensor in self.sensors:
+                h_s_v=sensor.h_s_v
+                if h_s_v is None:
+                    snapshot+=self.snapshot_pixel.pack(0.0, 0, 0, 0, math.nan)
+                    continue
+                try:
+                    source_value=float(sensor.last_value)
+                except (TypeError, ValueError):
+                    source_value=math.nan
+                snapshot+=self.snapshot_pixel.pack(sensor.last_update, int(h_s_v[0]) % 360, int(h_s_v[1]), int(h_s_v[2]), source_value)
+        snapshot+=struct.pack('<I', zlib.crc32(snapshot))
+        temporary_file=self.snapshot_file + '.tmp'
+        try: # Written to a temporary file and renamed, so that a crash never leaves a partial snapshot
+            with open(temporary_file, 'wb') as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary_file, self.snapshot_file)
+        except OSError as error:
+            print('Unable to save display snapshot', error)
+
+    def restore_snapshot(self): # Loads the last saved display state, dimming or blanking pixels older than snapshot_max_age
+        try:
+            with open(self.snapshot_file, 'rb') as f:
+                snapshot=f.read()
+        except OSError:
+            return False
+        snapshot_size=self.snapshot_header.size + 64*self.snapshot_pixel.size
+        if len(snapshot)!=snapshot_size+4 or struct.unpack_from('<I', snapshot, snapshot_size)[0]!=zlib.crc32(snapshot[:snapshot_size]):
+            print('Ignoring invalid display snapshot', self.snapshot_file)
+            return False
+        magic, snapshot_time, low_light=self.snapshot_header.unpack_from(snapshot, 0)
+        if magic!=b'NHMSNAP1':
+            return False
+        restore_time=time.time()
+        with self.display_lock:
+            self.low_light=bool(low_light)
+            self.low_light_dirty=True
+            for index in range(64):
+                update_time, hue, saturation, brightness, source_value=self.snapshot_pixel.unpack_from(snapshot, self.snapshot_header.size + index*self.snapshot_pixel.size)
+                if update_time==0:
+                    continue
+                h_s_v=[hue, saturation, brightness]
+                sensor=self.sensors[index]
+                sensor.h_s_v=h_s_v
+                sensor.last_value=None if math.isnan(source_value) else source_value
+                sensor.last_update=update_time
+                self.schedule_expiry(index, update_time)
+                if restore_time - update_time > self.snapshot_max_age:
+                    if self.snapshot_stale_action=='blank':
+                        h_s_v=[0,0,0]
+                    else:
+                        h_s_v=[hue, saturation, min(brightness, self.snapshot_dim_brightness)]
+                self.pending_updates[index]=h_s_v
+            self.request_frame()
+        self.print_update('Display restored from snapshot saved '+str(round(restore_time - snapshot_time))+' seconds ago on ')
+        return True
+
+    def save_snapshots_periodically(self):
+        while True:
+            time.sleep(self.snapshot_interval)
+            if self.snapshot_due:
+                self.save_snapshot()
+
+    async def save_snapshots_periodically_async(self): # The file is written in an executor so that the event loop isn't held up by the SD card
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            if self.snapshot_due:
+                await self.event_loop.run_in_executor(None, self.save_snapshot)
+
+    def start_snapshots(self):
+        if self.event_loop is None:
+            threading.Thread(target=self.save_snapshots_periodically, name='display_snapshots', daemon=True).start()
+        else:
+            self.event_loop.create_task(self.save_snapshots_periodically_async())
+
+    def start_metrics(self): # Starts the http endpoint and mqtt publishing, if they're configured
+        if self.metrics is None:
+            return
+        if self.metrics_http_port is not None:
+            metrics_server=http.server.ThreadingHTTPServer((self.metrics_http_address, self.metrics_http_port), MetricsRequestHandler)
+            metrics_server.daemon_threads=True
+            metrics_server.display=self
+            threading.Thread(target=metrics_server.serve_forever, name='metrics_http', daemon=True).start()
+        if self.metrics_mqtt_topic is not None:
+            if self.event_loop is None:
+                threading.Thread(target=self.publish_metrics_periodically, name='metrics_mqtt', daemon=True).start()
+            else: # Publishing has to happen on the event loop when it's servicing the mqtt socket
+                self.event_loop.create_task(self.publish_metrics_periodically_async())
+
+    def publish_metrics(self):
+        client.publish(self.metrics_mqtt_topic, json.dumps(self.metrics_report()))
+
+    def publish_metrics_periodically(self):
+        while True:
+            time.sleep(self.metrics_publish_interval)
+            self.publish_metrics()
+
+    async def publish_metrics_periodically_async(self):
+        while True:
+            await asyncio.sleep(self.metrics_publish_interval)
+            self.publish_metrics()
+
+    def open_display_backend(self):
+        if self.framebuffer_display:
+            device_path=self.framebuffer_device or find_sense_hat_framebuffer()
+            if device_path is None:
+                raise RuntimeError('Sense HAT framebuffer not found')
+            self.display_backend=FramebufferDisplay(device_path, self.display_rotation)
+            self.display_backend.clear()
+        else:
+            self.display_backend=SenseHatDisplay(sense, self.display_rotation, self.full_frame_threshold)
+
+    def set_led_colour(self, hue_value, saturation_value, brightness):
+        return self.hsv_lut.lookup(hue_value, saturation_value, brightness)
+
+    def set_led_colours(self, h_s_v_list): # Converts a list of [hue, saturation, brightness] triples in one call
+        return self.hsv_lut.lookup_batch(h_s_v_list)
 
     def print_update(self, print_message): # Prints with a date and time stamp
         today = datetime.now()
         print(print_message + today.strftime('%A %d %B %Y @ %H:%M:%S'))
          
     def shutdown_cleanup(self):
-        sense.clear()
+        if self.display_role!='follower': # Followers get the leader's retained frame on startup instead
+            self.save_snapshot()
+        if self.barometer_store is not None:
+            barometer_store=self.barometer_store
+            self.barometer_store=None
+            barometer_store.close()
+        self.display_backend.clear()
+        self.display_backend.close()
         client.loop_stop() # Stop mqtt monitoring
         self.print_update("Northcliff Home Manager Display stopped on ")
         
+    def attach_event_loop(self, event_loop): # Services mqtt from the event loop's socket callbacks instead of paho's network thread
+        self.event_loop=event_loop
+        client.on_socket_open=lambda client, userdata, sock: event_loop.add_reader(sock, client.loop_read)
+        client.on_socket_close=lambda client, userdata, sock: event_loop.remove_reader(sock)
+        client.on_socket_register_write=lambda client, userdata, sock: event_loop.add_writer(sock, client.loop_write)
+        client.on_socket_unregister_write=lambda client, userdata, sock: event_loop.remove_writer(sock)
+
+    async def service_mqtt(self): # Keepalives, retries and reconnection that paho's network thread would otherwise handle
+        reconnect_delay=1
+        while True:
+            if client.loop_misc()==mqtt.MQTT_ERR_NO_CONN:
+                try:
+                    client.reconnect()
+                    reconnect_delay=1
+                except OSError as error:
+                    self.print_update('Northcliff Home Manager Display Reconnection Failed ('+str(error)+') on ')
+                    reconnect_delay=min(reconnect_delay*2, 60)
+                await asyncio.sleep(reconnect_delay)
+            else:
+                await asyncio.sleep(1)
+
+    async def run_async(self):
+        mqtt_task=self.event_loop.create_task(self.service_mqtt())
+        self.start_metrics()
+        if self.display_role=='follower': # Frame pushes are scheduled as the leader's frames arrive, so there's nothing else to run
+            try:
+                await self.event_loop.create_future()
+            finally:
+                mqtt_task.cancel()
+        self.start_snapshots()
+        self.start_frame_publishing()
+        self.domoticz_publisher.start()
+        try:
+            self.open_barometer_store()
+            self.barometer_sampler.start()
+            self.arm_expiry_timer()
+            while not self.barometer_sampler.first_sample.is_set(): # Polled rather than waited on in an executor, so a failed sensor can't leave a worker thread blocked at exit
+                await asyncio.sleep(1)
+            valid_barometer_reading, barometer_log_time, barometer_reading_time = self.process_barometer(log=True)
+            while True: # Frame pushes and expiry checks are scheduled separately, so this only needs to wake when the barometer is due
+                barometer_due_time=min(barometer_log_time + self.barometer_log_interval, barometer_reading_time + self.barometer_read_interval)
+                await asyncio.sleep(max(0, barometer_due_time - time.time()))
+                if (time.time() - barometer_log_time) >= self.barometer_log_interval:
+                    valid_barometer_reading, barometer_log_time, barometer_reading_time = self.process_barometer(log=True)
+                else:
+                    valid_barometer_reading, barometer_reading_time = self.process_barometer(log=False)
+        finally:
+            mqtt_task.cancel()
+
+    def run_event_loop(self):
+        self.print_update("Northcliff Home Manager Display started in asyncio mode on ")
+        try:
+            self.event_loop.run_until_complete(self.run_async())
+        except KeyboardInterrupt: # Shutdown on ctrl C
+            print('Barometer Log:', self.barometer_history)
+            self.shutdown_cleanup()
+
+    def run_follower(self): # Only pushes the frames that arrive from the leader
+        self.print_update("Northcliff Home Manager Display started as a follower on ")
+        self.start_metrics()
+        try:
+            while True:
+                self.display_changed.wait()
+                frame_delay=self.last_frame_time + 1/self.max_frame_rate - time.time()
+                if frame_delay > 0:
+                    time.sleep(frame_delay)
+                self.display_changed.clear()
+                self.drive_display()
+        except KeyboardInterrupt: # Shutdown on ctrl C
+            self.shutdown_cleanup()
+
     def run(self):
         self.print_update("Northcliff Home Manager Display started on ")
+        self.start_metrics()
+        self.start_snapshots()
+        self.start_frame_publishing()
+        self.domoticz_publisher.start()
         try:
-            valid_barometer_reading=False
-            while valid_barometer_reading==False: # Wait for valid barometer reading
-                valid_barometer_reading, barometer_log_time, barometer_reading_time = self.process_barometer(log=True)
+            self.open_barometer_store()
+            self.barometer_sampler.start()
+            barometer_started=False # The barometer isn't due until the sampler has a valid reading, so a slow or failed sensor can't hold up the display
             while True: # Run display in continuous loop
-                time.sleep(0.5)
-                self.drive_display()
-                if (time.time() - barometer_log_time) >= 1200: # Read and update the barometer log if last update was >= 20 minutes ago
+                if not barometer_started and self.barometer_sampler.first_sample.is_set():
+                    barometer_started=True
                     valid_barometer_reading, barometer_log_time, barometer_reading_time = self.process_barometer(log=True)
-                elif (time.time() - barometer_reading_time) >= 300: # Read without logging if the last reading was >= 5 minutes ago
+                if barometer_started:
+                    barometer_due_time=min(barometer_log_time + self.barometer_log_interval, barometer_reading_time + self.barometer_read_interval)
+                else:
+                    barometer_due_time=time.time() + 1 # Check for the first reading again in a second
+                with self.display_lock:
+                    next_expiry_time=self.expiry_scheduler.next_deadline()
+                if next_expiry_time is not None and next_expiry_time < barometer_due_time:
+                    wake_time=next_expiry_time
+                else:
+                    wake_time=barometer_due_time
+                if self.display_changed.wait(max(0, wake_time - time.time())): # Sleep until the display changes, a pixel expires or the barometer is due
+                    frame_delay=self.last_frame_time + 1/self.max_frame_rate - time.time()
+                    if frame_delay > 0: # Hold off to respect the maximum frame rate, picking up any further changes in the meantime
+                        time.sleep(frame_delay)
+                    self.display_changed.clear()
+                    self.drive_display()
+                if next_expiry_time is not None and time.time() >= next_expiry_time:
+                    self.expire_stale_pixels()
+                if not barometer_started: # Picked up at the top of the loop once the sampler has a valid reading
+                    pass
+                elif (time.time() - barometer_log_time) >= self.barometer_log_interval: # Read and update the barometer log if last update was >= 20 minutes ago
+                    valid_barometer_reading, barometer_log_time, barometer_reading_time = self.process_barometer(log=True)
+                elif (time.time() - barometer_reading_time) >= self.barometer_read_interval: # Read without logging if the last reading was >= 5 minutes ago
                     valid_barometer_reading, barometer_reading_time = self.process_barometer(log=False)
                 else:
                     pass
@@ -421,19 +1638,33 @@ class NorthcliffDisplay(object): # The class for the main display code
             self.shutdown_cleanup()
             
 if __name__ == '__main__': # This is where to overall code kicks off
+    if SenseHat is None:
+        raise SystemExit('The sense_hat library is required to run the Northcliff Home Manager Display')
     sense = SenseHat()
-    sense.set_rotation(180)
-    sense.clear()
     # Create a Home Manager Display instance
     dsp = NorthcliffDisplay()
+    dsp.open_display_backend()
+    if dsp.display_role!='follower' and dsp.restore_snapshot(): # Show the last known state before waiting for the mqtt connection
+        dsp.drive_display()
     # Create and set up an mqtt instance                             
-    client = mqtt.Client('home_manager_display')
+    client_id='home_manager_display'
+    if dsp.display_role=='follower': # Each follower needs its own client id
+        client_id+='_' + os.uname().nodename
+    client = mqtt.Client(client_id)
     client.on_connect = dsp.on_connect
-    client.on_message = dsp.on_message
-    client.connect("<Your mqtt broker name>", 1883, 60)
-    # Blocking call that processes network traffic, dispatches callbacks and handles reconnecting.
-    client.loop_start()
-    dsp.run()
+    client.on_message = dsp.on_frame_message if dsp.display_role=='follower' else dsp.on_message
+    if dsp.asyncio_runtime: # Run mqtt, barometer readings and frame pushes on one event loop
+        dsp.attach_event_loop(asyncio.new_event_loop())
+        client.connect("<Your mqtt broker name>", 1883, 60)
+        dsp.run_event_loop()
+    else:
+        client.connect("<Your mqtt broker name>", 1883, 60)
+        # Blocking call that processes network traffic, dispatches callbacks and handles reconnecting.
+        client.loop_start()
+        if dsp.display_role=='follower':
+            dsp.run_follower()
+        else:
+            dsp.run()
 
 
 
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# Northcliff Home Manager Display - mqtt traffic recorder and replay benchmark
+# Records the Home Manager traffic that the display listens to, then replays it through NorthcliffDisplay.on_message
+# against a stand-in Sense HAT and mqtt client, so the display can be measured without a broker or a Sense HAT
+import argparse
+import json
+import struct
+import sys
+import time
+import NHMDisplay_Gen
+
+
+capture_file_header = b'NHMCAP1\n'
+capture_record = struct.Struct('<dBI') # Seconds since the start of the capture, topic number and payload length, followed by the payload
+
+
+class ReplaySense(object): # Stands in for the SenseHat, counting display writes
+    def __init__(self, pressure=1013.25):
+        self.pressure = pressure
+        self.low_light = False
+        self.pixels = [(0,0,0) for a in range(64)]
+        self.full_frame_writes = 0
+        self.pixel_writes = 0
+
+    def set_rotation(self, rotation):
+        pass
+
+    def clear(self):
+        self.pixels = [(0,0,0) for a in range(64)]
+
+    def set_pixels(self, pixel_list):
+        self.pixels = [tuple(pixel) for pixel in pixel_list]
+        self.full_frame_writes += 1
+
+    def set_pixel(self, x, y, pixel):
+        self.pixels[x+y*8] = tuple(pixel)
+        self.pixel_writes += 1
+
+    def get_pressure(self):
+        return self.pressure
+
+
+class ReplayPublishInfo(object): # Has the parts of a paho MQTTMessageInfo that the display uses. Replayed publishes are sent straight away
+    __slots__ = ('rc',)
+
+    def __init__(self, rc):
+        self.rc = rc
+
+    def is_published(self):
+        return True
+
+
+class ReplayClient(object): # Stands in for the paho client, keeping what would have been published
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload))
+        return ReplayPublishInfo(NHMDisplay_Gen.mqtt.MQTT_ERR_SUCCESS)
+
+    def subscribe(self, topic):
+        pass
+
+    def is_connected(self):
+        return True
+
+    def loop_stop(self):
+        pass
+
+
+class ReplayMessage(object): # Has the attributes of a paho MQTTMessage that on_message uses
+    __slots__ = ('topic', 'payload')
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def record_traffic(broker, port, capture_file, duration):
+    import paho.mqtt.client as mqtt
+    dsp = NHMDisplay_Gen.NorthcliffDisplay()
+    topics = [dsp.homebridge_outgoing_mqtt_topic, dsp.domoticz_incoming_mqtt_topic]
+    topic_numbers = {topic: number for number, topic in enumerate(topics)}
+    start_time = time.time()
+    count = 0
+    with open(capture_file, 'wb') as f:
+        f.write(capture_file_header)
+        f.write(json.dumps(topics).encode() + b'\n')
+
+        def on_connect(client, userdata, flags, rc):
+            for topic in topics:
+                client.subscribe(topic)
+
+        def on_message(client, userdata, msg):
+            nonlocal count
+            f.write(capture_record.pack(time.time() - start_time, topic_numbers[msg.topic], len(msg.payload)))
+            f.write(msg.payload)
+            count += 1
+
+        client = mqtt.Client('home_manager_display_recorder')
+        client.on_connect = on_connect
+        client.on_message = on_message
+        client.connect(broker, port, 60)
+        client.loop_start()
+        try:
+            time.sleep(duration)
+        except KeyboardInterrupt:
+            pass
+        client.loop_stop()
+    print('Recorded', count, 'messages in', round(time.time() - start_time, 1), 'seconds to', capture_file)
+
+
+def load_capture(capture_file): # Returns a list of (seconds since the start of the capture, topic, payload)
+    with open(capture_file, 'rb') as f:
+        if f.readline() != capture_file_header:
+            raise ValueError(capture_file + ' is not a Home Manager Display capture file')
+        topics = json.loads(f.readline())
+        contents = f.read()
+    messages = []
+    offset = 0
+    while offset + capture_record.size <= len(contents):
+        timestamp, topic_number, payload_length = capture_record.unpack_from(contents, offset)
+        offset += capture_record.size
+        if offset + payload_length > len(contents): # Recording was interrupted part way through a message
+            break
+        messages.append((timestamp, topics[topic_number], contents[offset:offset+payload_length]))
+        offset += payload_length
+    return messages
+
+
+def time_handler(handler, handler_times): # Wraps a message handler to accumulate its call count and run time
+    def timed_handler(parsed_json):
+        start_time = time.perf_counter()
+        handler(parsed_json)
+        handler_times[handler.__name__][0] += 1
+        handler_times[handler.__name__][1] += time.perf_counter() - start_time
+    return timed_handler
+
+
+def replay_traffic(messages, realtime=False):
+    NHMDisplay_Gen.sense = ReplaySense()
+    NHMDisplay_Gen.client = ReplayClient()
+    dsp = NHMDisplay_Gen.NorthcliffDisplay()
+    dsp.open_display_backend()
+    handlers = set(dsp.homebridge_name_routes.values()) | set(dsp.homebridge_service_routes.values()) | set(dsp.domoticz_idx_routes.values())
+    handlers.add(dsp.process_aircon)
+    handler_times = {}
+    for handler in handlers:
+        handler_times[handler.__name__] = [0, 0.0]
+        setattr(dsp, handler.__name__, time_handler(handler, handler_times))
+    dsp.compile_message_router() # Pick up the timed handlers
+    frame_interval = 1/dsp.max_frame_rate
+    frame_boundaries = 0
+    last_frame_timestamp = 0
+    replay_messages = [(timestamp, ReplayMessage(topic, payload)) for timestamp, topic, payload in messages]
+    start_time = time.perf_counter()
+    for timestamp, msg in replay_messages:
+        if realtime:
+            delay = timestamp - (time.perf_counter() - start_time)
+            if delay > 0:
+                time.sleep(delay)
+        if timestamp - last_frame_timestamp >= frame_interval: # Frame boundaries follow the capture's clock, so results don't depend on replay speed
+            dsp.drive_display()
+            frame_boundaries += 1
+            last_frame_timestamp = timestamp
+        dsp.on_message(NHMDisplay_Gen.client, None, msg)
+    dsp.drive_display()
+    frame_boundaries += 1
+    elapsed_time = time.perf_counter() - start_time
+    return {'messages': len(messages), 'elapsed_seconds': elapsed_time,
+            'messages_per_second': len(messages)/elapsed_time if elapsed_time else 0.0,
+            'handlers': {name: {'calls': calls, 'total_seconds': total, 'mean_microseconds': total/calls*1e6 if calls else 0.0}
+                         for name, (calls, total) in sorted(handler_times.items())},
+            'skipped_early': dict(dsp.messages_skipped_early), 'coalesced_updates': dsp.coalesced_updates,
+            'frame_boundaries': frame_boundaries, 'pixel_writes': NHMDisplay_Gen.sense.pixel_writes,
+            'full_frame_writes': NHMDisplay_Gen.sense.full_frame_writes, 'low_light': dsp.low_light,
+            'final_frame': [dsp.display_buffer[offset:offset+3].hex() for offset in range(0, 192, 3)]}
+
+
+def print_results(results):
+    print('Replayed', results['messages'], 'messages in', round(results['elapsed_seconds'], 3), 'seconds:',
+          round(results['messages_per_second']), 'messages per second')
+    print('Skipped before parsing:', results['skipped_early'], 'Coalesced updates:', results['coalesced_updates'])
+    print('Frame boundaries:', results['frame_boundaries'], 'Pixel writes:', results['pixel_writes'], 'Full frame writes:', results['full_frame_writes'])
+    print('{:<30}{:>10}{:>14}{:>12}'.format('Handler', 'Calls', 'Total ms', 'Mean us'))
+    for name, timing in results['handlers'].items():
+        print('{:<30}{:>10}{:>14.2f}{:>12.2f}'.format(name, timing['calls'], timing['total_seconds']*1000, timing['mean_microseconds']))
+    print('Final frame (low light ' + str(results['low_light']) + '):')
+    for row in range(8):
+        print(' '.join(results['final_frame'][row*8:row*8+8]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record and replay Northcliff Home Manager Display mqtt traffic')
+    commands = parser.add_subparsers(dest='command', required=True)
+    record_parser = commands.add_parser('record', help='Capture Home Manager traffic from an mqtt broker')
+    record_parser.add_argument('capture_file')
+    record_parser.add_argument('--broker', required=True)
+    record_parser.add_argument('--port', type=int, default=1883)
+    record_parser.add_argument('--duration', type=float, default=3600, help='Seconds to record for. Ctrl C stops early')
+    replay_parser = commands.add_parser('replay', help='Replay a capture through the display and report its performance')
+    replay_parser.add_argument('capture_file')
+    replay_parser.add_argument('--realtime', action='store_true', help="Replay at the capture's pace rather than as fast as possible")
+    replay_parser.add_argument('--repeat', type=int, default=1, help='Replay the capture this many times back to back')
+    replay_parser.add_argument('--json', help='Also write the results to this file')
+    replay_parser.add_argument('--max-mean-microseconds', type=float,
+                               help='Exit with an error if the mean time per message is higher than this, to catch performance regressions')
+    args = parser.parse_args()
+    if args.command == 'record':
+        record_traffic(args.broker, args.port, args.capture_file, args.duration)
+        return
+    messages = load_capture(args.capture_file)
+    if messages and args.repeat > 1:
+        capture_length = messages[-1][0]
+        messages = [(timestamp + repeat*capture_length, topic, payload) for repeat in range(args.repeat) for timestamp, topic, payload in messages]
+    results = replay_traffic(messages, args.realtime)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.max_mean_microseconds is not None and results['messages']:
+        mean_microseconds = results['elapsed_seconds']/results['messages']*1e6
+        if mean_microseconds > args.max_mean_microseconds:
+            sys.exit('Mean of ' + str(round(mean_microseconds, 2)) + ' microseconds per message exceeds ' + str(args.max_mean_microseconds))
+
+
+if __name__ == '__main__':
+    main()